@@ -0,0 +1,162 @@
+# This file contains the precomputed decrement and discount-factor tables shared by the projection calculations.
+
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+import numpy as np
+from app.utils.shared_state import shared_counters
+
+# Upper bound on the memory held by the cached vectors (in bytes)
+TABLE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+
+
+class TableCache:
+    """
+        Least recently used cache of NumPy vectors bounded by the total size of the cached arrays.
+
+        Cached arrays are made read-only because the same object is shared by every row and request.
+    """
+
+    def __init__(self, max_bytes: int = TABLE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.counters_name = "table_cache"
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """
+            Returns the cached vector for key, computing and storing it on a miss.
+
+            Args :
+            key : Hashable key identifying the vector.
+            compute : Function with no arguments returning the NumPy array for key.
+
+            Returns :
+            A read-only NumPy array.
+        """
+
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+                shared_counters.add(self.counters_name, "hits")
+                return array
+        shared_counters.add(self.counters_name, "misses")
+
+        # Compute outside the lock, identical concurrent misses only waste a little CPU
+        array = compute()
+        array.setflags(write=False)
+
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            if array.nbytes > self.max_bytes:
+                return array
+            self._entries[key] = array
+            self.current_bytes += array.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+        return array
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+            Returns the hits and misses of all workers and the size of the cache of this worker.
+        """
+        totals = shared_counters.totals(self.counters_name)
+        with self._lock:
+            return {
+                "hits": int(totals.get("hits", 0)),
+                "misses": int(totals.get("misses", 0)),
+                "worker_entries": len(self._entries),
+                "worker_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+table_cache = TableCache()
+
+
+class ProjectionTables(NamedTuple):
+    """
+        Vectors indexed by projection year t = 0 .. total_years.
+    """
+    survival: np.ndarray
+    in_force: np.ndarray
+    discount_factors: np.ndarray
+    accretion_factors: np.ndarray
+
+
+def _years(total_years):
+    return np.arange(int(total_years) + 1, dtype=np.float64)
+
+
+def survival_curve(mortality: float, total_years: int):
+    """
+        Probability of surviving (mortality only) from the start of the projection to year t.
+    """
+    key = ("survival", float(mortality), int(total_years))
+    return table_cache.get_or_compute(key, lambda: np.power(1.0 - float(mortality), _years(total_years)))
+
+
+def in_force_curve(mortality: float, lapse: float, total_years: int):
+    """
+        Proportion of policies still in force in year t after both mortality and lapse decrements.
+    """
+    key = ("in_force", float(mortality), float(lapse), int(total_years))
+    return table_cache.get_or_compute(
+        key,
+        lambda: np.power((1.0 - float(mortality)) * (1.0 - float(lapse)), _years(total_years)),
+    )
+
+
+def discount_factors(discount_rate: float, total_years: int):
+    """
+        Discount factors (1 + discount_rate) ^ -t.
+    """
+    key = ("discount", float(discount_rate), int(total_years))
+    return table_cache.get_or_compute(key, lambda: np.power(1.0 + float(discount_rate), -_years(total_years)))
+
+
+def accretion_factors(csm_ret_rate: float, total_years: int):
+    """
+        CSM interest accretion factors (1 + csm_ret_rate) ^ t.
+    """
+    key = ("accretion", float(csm_ret_rate), int(total_years))
+    return table_cache.get_or_compute(key, lambda: np.power(1.0 + float(csm_ret_rate), _years(total_years)))
+
+
+def _assumption(row, name):
+    value = row[name]
+    # NaN keys never compare equal, they would miss the cache on every call
+    if value is None or value != value:
+        raise ValueError(f"Assumption '{name}' is missing for record {row.get('id')}")
+    return value
+
+
+def projection_tables(row):
+    """
+        Returns the shared decrement and discount tables for a main_input row.
+
+        Args :
+        row : A mapping with the main_input columns (mortality, lapse, discount_rate, csm_ret_rate, total_years),
+              e.g. a dictionary returned by read_table.
+
+        Returns :
+        ProjectionTables with read-only vectors. Rows with the same assumptions receive the same arrays.
+        Raises ValueError if one of the assumptions is NULL or NaN.
+    """
+    total_years = _assumption(row, "total_years")
+    mortality = _assumption(row, "mortality")
+    return ProjectionTables(
+        survival=survival_curve(mortality, total_years),
+        in_force=in_force_curve(mortality, _assumption(row, "lapse"), total_years),
+        discount_factors=discount_factors(_assumption(row, "discount_rate"), total_years),
+        accretion_factors=accretion_factors(_assumption(row, "csm_ret_rate"), total_years),
+    )
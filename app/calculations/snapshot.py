@@ -0,0 +1,231 @@
+# This file contains the compact column-oriented snapshot of the main_input portfolio used by calculation runs.
+
+import json
+import os
+import re
+import shutil
+import uuid
+import numpy as np
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import select
+from app.models.main_input import MainInput
+from app.database.conditions import read_build_conditions
+from app.utils.logger import log_performance
+
+# Number of rows fetched from the database per chunk while building a snapshot
+SNAPSHOT_CHUNK_SIZE = 10000
+
+# Placeholder stored in the data array where a value is NULL, the validity mask is the source of truth
+NULL_PLACEHOLDER = {np.dtype(np.int64): 0, np.dtype(np.float64): np.nan}
+
+# Name of the file listing the columns of a saved snapshot
+MANIFEST_FILE = "manifest.json"
+
+# Number of saved snapshot versions kept next to the current one, for readers still opening an older one
+KEEP_PREVIOUS_VERSIONS = 1
+
+
+def _column_dtype(column):
+    if column.type.python_type is int:
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+class PortfolioSnapshot:
+    """
+        Struct-of-arrays view of a portfolio : one typed NumPy array per column, sorted by id.
+
+        NumPy arrays have no NULL, so a column holding NULLs also gets a boolean validity mask
+        (True where the value is present). Columns without NULLs have no mask.
+
+        The arrays can be saved to a directory and memory-mapped back, so several worker processes
+        share the same pages instead of each holding its own copy.
+    """
+
+    def __init__(self, columns: dict, masks: dict = None):
+        self.columns = columns
+        self.masks = masks or {}
+        self.ids = columns["id"]
+
+        for name, array in columns.items():
+            if len(array) != len(self.ids):
+                raise ValueError(f"Column '{name}' has {len(array)} values, expected {len(self.ids)}")
+        for name, mask in self.masks.items():
+            if name not in columns or len(mask) != len(self.ids):
+                raise ValueError(f"Invalid validity mask for column '{name}'")
+        if "id" in self.masks:
+            raise ValueError("The id column can not contain NULLs")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, column_name):
+        return self.columns[column_name]
+
+    def valid(self, column_name):
+        """
+            Returns the validity mask of a column, or None if the column has no NULLs.
+        """
+        return self.masks.get(column_name)
+
+    def require(self, *column_names):
+        """
+            Raises ValueError if any of the given columns contains NULLs.
+        """
+        for name in column_names:
+            mask = self.masks.get(name)
+            if mask is not None and not mask.all():
+                missing = self.ids[~np.asarray(mask)][:10].tolist()
+                raise ValueError(f"Column '{name}' is NULL for ids {missing}")
+
+    def index_of(self, record_id):
+        """
+            Returns the position of record_id in the column arrays.
+        """
+        position = int(np.searchsorted(self.ids, record_id))
+        if position >= len(self.ids) or self.ids[position] != record_id:
+            raise KeyError(f"Record with id '{record_id}' not found in snapshot")
+        return position
+
+    def row(self, record_id):
+        """
+            Returns a single record as a dictionary, in the same shape as a read_table row (NULLs are None).
+        """
+        position = self.index_of(record_id)
+        row = {}
+        for name, array in self.columns.items():
+            mask = self.masks.get(name)
+            row[name] = array[position].item() if mask is None or mask[position] else None
+        return row
+
+    def save(self, directory: str):
+        """
+            Saves the snapshot so that readers of directory always see one complete snapshot.
+
+            The arrays are written to a new sibling directory and directory is a symbolic link
+            that is atomically switched to it.
+        """
+        directory = os.path.abspath(directory)
+        if os.path.exists(directory) and not os.path.islink(directory):
+            raise ValueError(f"'{directory}' exists and is not a snapshot link")
+
+        parent, name = os.path.split(directory)
+        os.makedirs(parent, exist_ok=True)
+        version_name = f"{name}.{uuid.uuid4().hex}"
+        version_directory = os.path.join(parent, version_name)
+        os.makedirs(version_directory)
+
+        for column_name, array in self.columns.items():
+            np.save(os.path.join(version_directory, f"{column_name}.npy"), np.ascontiguousarray(array))
+        for column_name, mask in self.masks.items():
+            np.save(os.path.join(version_directory, f"{column_name}.mask.npy"), np.ascontiguousarray(mask))
+        manifest = {"rows": len(self), "columns": list(self.columns), "masks": list(self.masks)}
+        with open(os.path.join(version_directory, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f)
+
+        previous = os.readlink(directory) if os.path.islink(directory) else None
+
+        # Switch the link in one rename so readers see either the old or the new snapshot
+        temp_link = os.path.join(parent, f".{name}.{uuid.uuid4().hex}.link")
+        os.symlink(version_name, temp_link)
+        os.replace(temp_link, directory)
+
+        if previous is not None:
+            self._remove_old_versions(parent, name, keep={version_name, os.path.basename(previous)})
+
+    @staticmethod
+    def _remove_old_versions(parent, name, keep):
+        # Only directories written by save() : '<name>.<32 hex digits>' holding a manifest
+        version_pattern = re.compile(rf"^{re.escape(name)}\.[0-9a-f]{{32}}$")
+        versions = [
+            entry for entry in os.scandir(parent)
+            if entry.is_dir(follow_symlinks=False) and version_pattern.match(entry.name) and entry.name not in keep
+            and os.path.isfile(os.path.join(entry.path, MANIFEST_FILE))
+        ]
+        versions.sort(key=lambda entry: entry.stat(follow_symlinks=False).st_mtime, reverse=True)
+        for entry in versions[max(KEEP_PREVIOUS_VERSIONS - 1, 0):]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True):
+        """
+            Loads a snapshot saved with save().
+
+            Args :
+            directory : The directory the snapshot was saved to.
+            mmap : If True the arrays are memory-mapped read-only instead of read into memory.
+
+            Returns :
+            A PortfolioSnapshot.
+        """
+        # Resolve the link once so every file comes from the same snapshot version
+        version_directory = os.path.realpath(directory)
+        manifest_path = os.path.join(version_directory, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            raise ValueError(f"No portfolio snapshot found in '{directory}'")
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        mmap_mode = "r" if mmap else None
+        columns = {
+            name: np.load(os.path.join(version_directory, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in manifest["columns"]
+        }
+        masks = {
+            name: np.load(os.path.join(version_directory, f"{name}.mask.npy"), mmap_mode=mmap_mode)
+            for name in manifest["masks"]
+        }
+        snapshot = cls(columns, masks)
+        if len(snapshot) != manifest["rows"]:
+            raise ValueError(f"Snapshot in '{directory}' has {len(snapshot)} rows, expected {manifest['rows']}")
+        return snapshot
+
+
+@log_performance
+def load_main_input_snapshot(db: Session, columns: list = None, condition: dict = None):
+    """
+        Reads main_input straight into a PortfolioSnapshot without building a dictionary per row.
+
+        Args :
+        db : SQLAlchemy session.
+        columns : A list of columns to load, the id column is always included.
+        condition : A dictionary of conditions in the read_table format.
+
+        Returns :
+        A PortfolioSnapshot sorted by id.
+    """
+
+    table = MainInput.__table__
+
+    if columns is None:
+        selected_columns = list(table.c)
+    else:
+        selected_columns = [table.c["id"]] + [table.c[column] for column in columns if column != "id"]
+
+    query = select(*selected_columns).order_by(table.c["id"])
+    if condition:
+        query = query.where(read_build_conditions(table, condition))
+
+    dtypes = [_column_dtype(column) for column in selected_columns]
+    chunks = [[] for _ in selected_columns]
+    mask_chunks = [[] for _ in selected_columns]
+
+    # Stream the rows in chunks and transpose each chunk into typed arrays and validity masks
+    result = db.execute(query.execution_options(stream_results=True, yield_per=SNAPSHOT_CHUNK_SIZE))
+    for partition in result.partitions(SNAPSHOT_CHUNK_SIZE):
+        for position, values in enumerate(zip(*partition)):
+            placeholder = NULL_PLACEHOLDER[dtypes[position]]
+            mask_chunks[position].append(np.fromiter((value is not None for value in values), dtype=bool, count=len(values)))
+            chunks[position].append(
+                np.fromiter((placeholder if value is None else value for value in values), dtype=dtypes[position], count=len(values))
+            )
+
+    arrays = {}
+    masks = {}
+    for column, dtype, column_chunks, column_masks in zip(selected_columns, dtypes, chunks, mask_chunks):
+        arrays[column.name] = np.concatenate(column_chunks) if column_chunks else np.empty(0, dtype=dtype)
+        mask = np.concatenate(column_masks) if column_masks else np.empty(0, dtype=bool)
+        if not mask.all():
+            masks[column.name] = mask
+
+    return PortfolioSnapshot(arrays, masks)
@@ -0,0 +1,152 @@
+# This file contains the change log that records the writes made through the CRUD functions, with a version number per table.
+#
+# The versions and changes are kept in the shared state backend so every worker process sees the same feed.
+
+import asyncio
+import json
+import time
+from fastapi.concurrency import run_in_threadpool
+from app.utils.shared_state import shared_state
+from app.utils.logger import logger
+
+# Number of changes kept per table, clients further behind have to re-read the table
+MAX_CHANGES_PER_TABLE = 1000
+
+# Writes of up to this many rows log the full rows, larger ones only log primary keys
+MAX_CHANGE_ROWS = 100
+
+# Writes of more rows than this (or without primary keys) are logged as a reset
+MAX_CHANGE_KEYS = 1000
+
+# Seconds between two checks of the shared state while waiting for changes made by other workers
+POLL_INTERVAL = 0.25
+
+
+class ChangeLog:
+    """
+        Keeps the most recent changes of every table and lets readers wait for new ones.
+
+        Each write bumps the version of its table by one. A change entry holds the version, the
+        operation ('insert', 'update' or 'delete') and, depending on its size, the inserted rows,
+        the primary keys of the affected rows and the new values of an update. Writes too large to
+        describe are logged with 'reset' set, telling the clients to read the table again.
+    """
+
+    def __init__(self, backend, max_changes: int = MAX_CHANGES_PER_TABLE):
+        self.backend = backend
+        self.max_changes = max_changes
+        # Tables with a committed write this worker could not record, their next entry is a reset
+        self._missed = set()
+
+    def append(self, table_name: str, operation: str, rows: list = None, keys: list = None, values: dict = None):
+        """
+            Records a write to table_name.
+
+            Args :
+            table_name : The name of the written table.
+            operation : 'insert', 'update' or 'delete'.
+            rows : The full rows written, if small enough.
+            keys : The primary keys of the affected rows, if rows is not given.
+            values : The new values of an update.
+
+            Returns :
+            The new version of the table, or None if the change could not be recorded. Errors of the
+            shared state backend are logged and not raised, the write itself has already been committed.
+            The next change recorded for the table is then a reset, so the missed write shows in the feed.
+        """
+        entry = {"operation": operation}
+        if table_name in self._missed:
+            entry["reset"] = True
+        elif rows is not None:
+            entry["rows"] = rows
+        elif keys is not None:
+            entry["keys"] = keys
+        else:
+            entry["reset"] = True
+        if values is not None:
+            entry["values"] = values
+
+        # The version bump and the push run in one transaction, so the last entry of the list always
+        # carries the current version and the version of every entry follows from its position
+        key = f"changes:{table_name}"
+        try:
+            pipe = self.backend.pipeline()
+            pipe.incr(f"table_version:{table_name}")
+            pipe.rpush(key, json.dumps(entry, default=str))
+            pipe.ltrim(key, -self.max_changes, -1)
+            version = pipe.execute()[0]
+        except Exception as e:
+            self._missed.add(table_name)
+            logger.error(f"Could not record the {operation} on '{table_name}' in the change log: {e}")
+            return None
+        self._missed.discard(table_name)
+        return version
+
+    def version(self, table_name: str):
+        return int(self.backend.get(f"table_version:{table_name}") or 0)
+
+    def since(self, table_name: str, version: int):
+        """
+            Returns the changes made to table_name after version.
+
+            Returns :
+            A dictionary with the current version and the list of changes. 'reset' is True when the
+            requested changes are no longer retained (or the version is unknown) and the client has to
+            read the whole table again.
+        """
+        current = self.version(table_name)
+        if version > current:
+            return self._result(table_name, current, True, [])
+        if version == current:
+            return self._result(table_name, current, False, [])
+
+        # Fetch only the entries after version, re-reading if a write lands in between
+        while True:
+            missing = current - version
+            if missing > self.max_changes:
+                return self._result(table_name, current, True, [])
+            pipe = self.backend.pipeline()
+            pipe.get(f"table_version:{table_name}")
+            pipe.lrange(f"changes:{table_name}", -missing, -1)
+            latest, entries = pipe.execute()
+            latest = int(latest or 0)
+            if latest == current:
+                break
+            if latest < current:
+                # The shared state was cleared, the client's version is unknown
+                return self._result(table_name, latest, True, [])
+            current = latest
+
+        # A shorter list means the entries were trimmed or lost
+        if len(entries) < missing:
+            return self._result(table_name, current, True, [])
+
+        changes = []
+        for position, entry in enumerate(entries):
+            change = json.loads(entry)
+            if change.get("reset"):
+                return self._result(table_name, current, True, [])
+            change["version"] = version + 1 + position
+            changes.append(change)
+        return self._result(table_name, current, False, changes)
+
+    async def wait(self, table_name: str, version: int, timeout: float):
+        """
+            Same as since() but waits for up to timeout seconds until table_name moves past version.
+
+            Waiting happens on the event loop, only the short backend reads run in the threadpool.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            result = await run_in_threadpool(self.since, table_name, version)
+            remaining = deadline - time.monotonic()
+            if result["changes"] or result["reset"] or remaining <= 0:
+                return result
+            await asyncio.sleep(min(POLL_INTERVAL, remaining))
+
+    @staticmethod
+    def _result(table_name, version, reset, changes):
+        return {"table_name": table_name, "version": version, "reset": reset, "changes": changes}
+
+
+change_log = ChangeLog(shared_state)
@@ -10,7 +10,58 @@ from sqlalchemy.exc import SQLAlchemyError
 from app.database.connect import engine
 from sqlalchemy.sql import func
 from app.database.conditions import read_build_conditions, update_build_conditions, delete_build_conditions
-from app.utils.logger import log_performance
+from app.database.changes import change_log, MAX_CHANGE_ROWS, MAX_CHANGE_KEYS
+from app.utils.logger import log_performance, logger
+from app.utils.shared_state import shared_state
+
+# Schema version of every table reflected by this worker, compared with the shared one before reuse
+_reflected_schema_versions = {}
+
+def reflect_table(db: Session, table_name: str):
+    """
+        Returns the reflected table, reflecting it again if its schema was changed by any worker.
+        
+        Args :
+        db : SQLAlchemy session.
+        table_name : The name of the table to reflect.
+        
+        Returns :
+        SQLAlchemy Table object.
+    """
+    
+    try:
+        schema_version = shared_state.get(f"schema_version:{table_name}")
+    except Exception as e:
+        # Without the shared version keep using the table reflected by this worker
+        logger.warning(f"Could not read the schema version of '{table_name}': {e}")
+        schema_version = _reflected_schema_versions.get(table_name)
+    table = metadata.tables.get(table_name)
+    if table is not None and _reflected_schema_versions.get(table_name) != schema_version:
+        metadata.remove(table)
+    
+    table = Table(table_name, metadata, autoload_with=db.bind)
+    _reflected_schema_versions[table_name] = schema_version
+    return table
+
+def _fetch_change_rows(result, limit: int):
+    """
+        Collects the rows returned by a write for the change log.
+        
+        Returns :
+        The number of rows written and a list of dictionaries, or None if the statement returned no rows
+        or more than limit rows (the change is then logged as a reset).
+    """
+    if not result.returns_rows:
+        return result.rowcount, None
+    
+    # Count the rows ourselves, some drivers do not report rowcount for statements with RETURNING
+    rows = []
+    count = 0
+    for row in result:
+        count += 1
+        if count <= limit:
+            rows.append(dict(row._mapping))
+    return count, rows if count <= limit else None
 
 @log_performance
 def read_table(db: Session, table_name: str, columns: list = None, condition: dict = None):
@@ -30,7 +81,7 @@ def read_table(db: Session, table_name: str, columns: list = None, condition: di
     """
     
     # Reflect the table from the database
-    table = Table(table_name, metadata, autoload_with=db.bind)
+    table = reflect_table(db, table_name)
     
     # If no columns are specified, select all columns
     if columns is None:
@@ -70,7 +121,7 @@ def insert_record(db: Session, table_name: str, values: list, columns: list = No
     """
     
     # Reflect the table from the database
-    table = Table(table_name, metadata, autoload_with=db.bind)
+    table = reflect_table(db, table_name)
 
     # If no columns are specified, use all columns
     if columns is None:
@@ -80,12 +131,22 @@ def insert_record(db: Session, table_name: str, values: list, columns: list = No
     if not isinstance(values[0], dict):
         values = [dict(zip(columns, val)) for val in values]
     
-    # Prepare the insert statement
+    # Prepare the insert statement. The change log gets the full rows of small inserts,
+    # only the primary keys of larger ones and a reset for huge ones or tables without primary key
     insert_stmt = table.insert().values(values)
+    primary_key_columns = list(table.primary_key.columns)
+    if len(values) <= MAX_CHANGE_ROWS:
+        insert_stmt = insert_stmt.returning(*table.c)
+    elif primary_key_columns and len(values) <= MAX_CHANGE_KEYS:
+        insert_stmt = insert_stmt.returning(*primary_key_columns)
 
     # Execute the insert statement
-    db.execute(insert_stmt)
+    _, returned = _fetch_change_rows(db.execute(insert_stmt), MAX_CHANGE_KEYS)
     db.commit()
+    if len(values) <= MAX_CHANGE_ROWS:
+        change_log.append(table_name, "insert", rows=returned)
+    else:
+        change_log.append(table_name, "insert", keys=returned)
 
     return {"message": "Records inserted successfully"}
 
@@ -106,7 +167,7 @@ def update_table(db: Session, table_name: str, updates: dict, condition: dict =
     """
     try:
         # Reflect the table from the database
-        table = Table(table_name, metadata, autoload_with=db.bind)
+        table = reflect_table(db, table_name)
         
         # Build the update query with the new values
         query = update(table).values(**updates)
@@ -116,11 +177,21 @@ def update_table(db: Session, table_name: str, updates: dict, condition: dict =
             condition_clause = update_build_conditions(table, condition)
             query = query.where(condition_clause)
         
+        # The change log gets the primary keys of the updated rows with the new values. An update of
+        # the whole table, of a table without primary key, of a primary key column (clients only know
+        # the old keys) or of too many rows is logged as a reset
+        primary_key_columns = list(table.primary_key.columns)
+        updates_primary_key = any(column.name in updates for column in primary_key_columns)
+        if condition and primary_key_columns and not updates_primary_key:
+            query = query.returning(*primary_key_columns)
+        
         # Execute the update query
-        result = db.execute(query)
+        rows_updated, updated_keys = _fetch_change_rows(db.execute(query), MAX_CHANGE_KEYS)
         db.commit()
+        if rows_updated:
+            change_log.append(table_name, "update", keys=updated_keys, values=updates)
         
-        return {"rows_updated": result.rowcount}
+        return {"rows_updated": rows_updated}
     
     except SQLAlchemyError as e:
         db.rollback()
@@ -141,10 +212,13 @@ def delete_records(db: Session, table_name: str, condition: dict):
     """
     try:
         # Reflect the table from the database
-        table = Table(table_name, metadata, autoload_with=db.bind)
+        table = reflect_table(db, table_name)
         
-        # Build the delete query
+        # Build the delete query, returning the primary keys for the change log
         delete_query = delete(table)
+        primary_key_columns = list(table.primary_key.columns)
+        if primary_key_columns:
+            delete_query = delete_query.returning(*primary_key_columns)
         
         # Apply complex conditions if provided
         if condition:
@@ -154,10 +228,12 @@ def delete_records(db: Session, table_name: str, condition: dict):
             raise ValueError("Condition is required for deletion to avoid accidental data loss.")
         
         # Execute the delete query
-        result = db.execute(delete_query)
+        deleted_rows, deleted_keys = _fetch_change_rows(db.execute(delete_query), MAX_CHANGE_KEYS)
         db.commit()
+        if deleted_rows:
+            change_log.append(table_name, "delete", keys=deleted_keys)
         
-        return {"deleted_rows": result.rowcount}
+        return {"deleted_rows": deleted_rows}
     
     except SQLAlchemyError as e:
         db.rollback()
@@ -245,6 +321,11 @@ def create_table(db: Session, table_name: str, columns: list, primary_key: list
 
     try:
         metadata.create_all(engine)  # Create the table in the database
+        # Make every worker reflect the table again
+        try:
+            _reflected_schema_versions[table_name] = str(shared_state.incr(f"schema_version:{table_name}"))
+        except Exception as e:
+            logger.error(f"Could not publish the new schema of '{table_name}' to the other workers: {e}")
         return {"message": f"Table '{table_name}' created successfully"}
     except SQLAlchemyError as e:
         raise ValueError(str(e))
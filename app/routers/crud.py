@@ -1,27 +1,85 @@
 # routers/crud.py
 
-from fastapi import APIRouter, Depends , HTTPException
+from fastapi import APIRouter, Depends , HTTPException , Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from app.database.crud import read_table , insert_record , update_table , delete_records , create_table
 import json
+import hashlib
 from typing import Optional
 from sqlalchemy.exc import IntegrityError
 from typing import Optional
 import traceback
+from app.database.connect import SessionLocal
 from app.routers.utils import get_db, InsertRequest, DeleteRequest, CreateTableRequest
-from app.utils.logger import log_performance
+from app.utils.logger import log_performance, performance_metrics, logger
+from app.utils.shared_state import shared_state
+from app.utils.constants_n_credentials import READ_CACHE_TTL, READ_CACHE_MAX_BYTES
+from app.utils.single_flight import SingleFlight, normalise_condition
+from app.utils.admission import RouteLimiter, admit
+from app.database.changes import change_log
+from app.calculations.decrements import table_cache
 
 router = APIRouter()
 
+# Admission control for each handler. Queued requests wait on the event loop without holding a thread.
+# The concurrency limits together stay within the database pool (5 connections + 10 overflow) and the
+# threadpool (40 threads) so cheap requests are not starved by expensive ones.
+route_limiters = {
+    "read_table": RouteLimiter("read_table", rate=20, burst=40, max_concurrency=6, max_queue=24, queue_timeout=5.0),
+    "insert": RouteLimiter("insert", rate=5, burst=10, max_concurrency=3, max_queue=6, queue_timeout=10.0),
+    "update": RouteLimiter("update", rate=5, burst=10, max_concurrency=2, max_queue=6, queue_timeout=10.0),
+    "delete": RouteLimiter("delete", rate=5, burst=10, max_concurrency=2, max_queue=6, queue_timeout=10.0),
+    # Long-polls wait on the event loop and only borrow a thread for each short version check
+    "changes": RouteLimiter("changes", rate=5, burst=10, max_concurrency=64, max_queue=0, queue_timeout=0),
+    "create_table": RouteLimiter("create_table", rate=0.2, burst=2, max_concurrency=1, max_queue=2, queue_timeout=10.0, retry_after=5),
+}
+
+# Identical concurrent reads share one query execution and one serialised payload
+read_flight = SingleFlight("read_table")
+
+def _read_table_payload(cache_key, table_name, columns_list, condition_dict):
+    # Payloads are shared between workers when READ_CACHE_TTL is set, keyed by the table version so any
+    # write through the api invalidates them. The cache is skipped if the shared state is unavailable
+    if cache_key is not None:
+        try:
+            payload = shared_state.get(cache_key)
+        except Exception as e:
+            logger.warning(f"Could not read the read_table cache: {e}")
+            payload = None
+        if payload is not None:
+            return payload
+    
+    # The call is shared by several requests, so it uses its own session rather than the leader's
+    db = SessionLocal()
+    try:
+        data = read_table(db, table_name, columns=columns_list, condition=condition_dict)
+    finally:
+        db.close()
+    # Same settings as JSONResponse.render, NaN and Infinity fail instead of producing invalid JSON
+    payload = json.dumps(jsonable_encoder({"data": data}), ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+    
+    if cache_key is not None and len(payload) <= READ_CACHE_MAX_BYTES:
+        try:
+            shared_state.set(cache_key, payload, ex=READ_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Could not write the read_table cache: {e}")
+    return payload
+
+async def _read_table_leader(cache_key, table_name, columns_list, condition_dict):
+    # Only the leader of a flight takes a read_table slot, coalesced followers just await its result
+    async with route_limiters["read_table"].slot():
+        return await run_in_threadpool(_read_table_payload, cache_key, table_name, columns_list, condition_dict)
+
 # Dependency to get the database session
 
 @log_performance
-@router.get("/read_table/")
-def read_table_route(
+@router.get("/read_table/", dependencies=[Depends(admit(route_limiters["read_table"], hold_slot=False))])
+async def read_table_route(
     table_name: str, 
     columns: Optional[str] = None, 
     condition: Optional[str] = None, 
-    db: Session = Depends(get_db)
 ):  
     """
         API endpoint to read records from a specified table based on complex conditions.
@@ -30,7 +88,6 @@ def read_table_route(
         table_name : The name of the table to read records from.
         columns : A list of columns to select from the table.
         condition : A dictionary of conditions to filter the rows to read.
-        db : SQLAlchemy session.
         
         Returns :
         A list of dictionaries representing the selected columns of the records that match the condition.
@@ -43,15 +100,25 @@ def read_table_route(
         # Parse the condition if provided
         condition_dict = json.loads(condition) if condition else None
         
-        # Fetch data using the dynamic_read function
-        data = read_table(db, table_name, columns=columns_list, condition=condition_dict)
+        # Fetch data using the dynamic_read function, coalescing identical in-flight reads
+        key = (table_name, tuple(columns_list) if columns_list else None, normalise_condition(condition_dict))
+        cache_key = None
+        if READ_CACHE_TTL:
+            try:
+                version = await run_in_threadpool(change_log.version, table_name)
+                cache_key = "read:" + hashlib.sha1(json.dumps([*key, version]).encode("utf-8")).hexdigest()
+            except Exception as e:
+                logger.warning(f"Could not read the version of '{table_name}', skipping the read_table cache: {e}")
+        payload = await read_flight.do((*key, cache_key), _read_table_leader, cache_key, table_name, columns_list, condition_dict)
         
-        return {"data": data}
+        return Response(content=payload, media_type="application/json")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @log_performance
-@router.post("/insert/{table_name}")
+@router.post("/insert/{table_name}", dependencies=[Depends(admit(route_limiters["insert"]))])
 def insert_record_route(table_name: str, request: InsertRequest, db: Session = Depends(get_db)):
     """
         API endpoint to insert records into a specified table.
@@ -79,7 +146,7 @@ def insert_record_route(table_name: str, request: InsertRequest, db: Session = D
 
 
 @log_performance
-@router.put("/update/{table_name}")
+@router.put("/update/{table_name}", dependencies=[Depends(admit(route_limiters["update"]))])
 def update_table_route(table_name: str, updates: dict, condition: dict = None, db: Session = Depends(get_db)):
     """
         API endpoint to update records in a specified table.
@@ -101,7 +168,7 @@ def update_table_route(table_name: str, updates: dict, condition: dict = None, d
     return result
 
 @log_performance
-@router.delete("/delete/{table_name}")
+@router.delete("/delete/{table_name}", dependencies=[Depends(admit(route_limiters["delete"]))])
 def delete_records_route(table_name: str, delete_request: DeleteRequest, db: Session = Depends(get_db)):
     """
         API endpoint to delete records from a specified table based on complex conditions.
@@ -126,7 +193,7 @@ def delete_records_route(table_name: str, delete_request: DeleteRequest, db: Ses
         raise HTTPException(status_code=500, detail=str(e))    
     
 @log_performance
-@router.post("/create_table")
+@router.post("/create_table", dependencies=[Depends(admit(route_limiters["create_table"]))])
 def create_table_route(create_table_request: CreateTableRequest, db: Session = Depends(get_db)):
     """
         API endpoint to create a new table in the database.
@@ -152,4 +219,60 @@ def create_table_route(create_table_request: CreateTableRequest, db: Session = D
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Upper bound on how long a /changes/ request is held open
+MAX_CHANGES_WAIT = 30.0
+
+@log_performance
+@router.get("/changes/{table_name}", dependencies=[Depends(admit(route_limiters["changes"]))])
+async def changes_route(table_name: str, since: int = 0, timeout: float = 25.0):
+    """
+        Long-poll API endpoint returning the changes made to a table after a given version.
+        
+        Args :
+        table_name : The name of the table to watch.
+        since : The last version seen by the client, 0 for none.
+        timeout : Seconds to wait for a change before returning an empty list.
+        
+        Returns :
+        The current version of the table and the list of changes after since. If reset is True the
+        changes are no longer available (or too large to describe) and the table has to be read again
+        with /read_table/.
+    """
+    if timeout <= 0:
+        return await run_in_threadpool(change_log.since, table_name, since)
+    return await change_log.wait(table_name, since, min(timeout, MAX_CHANGES_WAIT))
+
+@router.get("/admission_stats")
+def admission_stats_route():
+    """
+        API endpoint to inspect the admission control counters.
+        
+        Returns :
+        For each handler, the number of admitted and shed requests across all workers and the current
+        load of the worker answering.
+    """
+    return {name: limiter.stats() for name, limiter in route_limiters.items()}
+
+@router.get("/cache_stats")
+def cache_stats_route():
+    """
+        API endpoint to inspect the read_table coalescing and the projection table cache.
+        
+        Returns :
+        The executed and coalesced reads and the projection table cache hits and misses across all workers,
+        with the in-flight reads and cache size of the worker answering.
+    """
+    return {"read_table_flight": read_flight.stats(), "projection_tables": table_cache.stats()}
+
+@router.get("/metrics")
+def metrics_route():
+    """
+        API endpoint to inspect the performance figures recorded by log_performance.
+        
+        Returns :
+        For each function, the number of calls, total and average execution time and total memory used
+        across all worker processes.
+    """
+    return performance_metrics.summary()
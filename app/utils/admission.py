@@ -0,0 +1,196 @@
+# This file contains the admission control used by the api handlers : per-client rate limits, per-route concurrency limits and load shedding.
+
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, Request
+from app.utils.logger import logger
+from app.utils.shared_state import shared_counters
+
+# Idle client buckets are dropped once this many clients are tracked by one route
+MAX_TRACKED_CLIENTS = 10000
+
+
+class TokenBucket:
+    """
+        Token bucket refilled at `rate` tokens per second up to `capacity` tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float):
+        """
+            Takes one token if available.
+
+            Returns :
+            0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RouteLimiter:
+    """
+        Admission control for one route.
+
+        All the state is only touched from the event loop : waiting requests are parked on futures,
+        so they do not hold a threadpool thread while queued. The admitted and shed counts are kept in
+        shared counters so the stats cover every worker process.
+
+        Args :
+        name : Name of the route, used in logs and stats.
+        rate : Requests per second allowed for each client (None disables the rate limit).
+        burst : Number of requests a client may make at once before being rate limited.
+        max_concurrency : Number of requests of this route executing at the same time.
+        max_queue : Number of requests allowed to wait for a free slot, further requests are shed.
+        queue_timeout : Seconds a request may wait for a free slot before being shed.
+        retry_after : Retry-After (seconds) returned when a request is shed.
+    """
+
+    def __init__(self, name: str, rate: float = None, burst: int = 1, max_concurrency: int = 8,
+                 max_queue: int = 16, queue_timeout: float = 5.0, retry_after: int = 1):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        self._buckets = {}
+        self._waiters = deque()
+        self.active = 0
+        self.counters_name = f"admission:{name}"
+
+    def check_rate(self, client: str):
+        """
+            Takes a token from the bucket of client or raises HTTPException (429).
+        """
+        if self.rate is None:
+            return
+        now = time.monotonic()
+        if len(self._buckets) > MAX_TRACKED_CLIENTS:
+            # A bucket idle long enough to be full again carries no state worth keeping
+            idle_after = self.burst / self.rate
+            self._buckets = {k: b for k, b in self._buckets.items() if now - b.updated < idle_after}
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+        wait = bucket.take(now)
+        if wait:
+            self._count("rate_limited")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded for '{self.name}'",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+    COUNTERS = ("admitted", "rate_limited", "queue_full", "queue_timeout")
+
+    def _count(self, counter: str):
+        shared_counters.add(self.counters_name, counter)
+
+    def _shed(self, reason: str):
+        self._count(reason)
+        logger.warning(f"Admission control shed a '{self.name}' request ({reason})")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Server is busy, '{self.name}' request was not admitted",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    async def acquire(self):
+        """
+            Waits for a free execution slot or raises HTTPException (503) if the request is shed.
+        """
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self._count("admitted")
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self._shed("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over right as the wait timed out
+            if not (waiter.done() and not waiter.cancelled()):
+                self._shed("queue_timeout")
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self._count("admitted")
+
+    def release(self):
+        """
+            Frees a slot, handing it over directly to the oldest waiting request if any.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """
+            Returns the admitted and shed counts of all workers and the current load of this worker.
+        """
+        totals = shared_counters.totals(self.counters_name)
+        counters = {counter: int(totals.get(counter, 0)) for counter in self.COUNTERS}
+        return {
+            **counters,
+            "shed": counters["rate_limited"] + counters["queue_full"] + counters["queue_timeout"],
+            "worker_active": self.active,
+            "worker_waiting": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+
+def admit(limiter: RouteLimiter, hold_slot: bool = True):
+    """
+        Builds a FastAPI dependency that applies the rate limit of limiter and, if hold_slot is True,
+        holds one of its execution slots for the duration of the request.
+
+        Routes passing hold_slot=False acquire the slot themselves with limiter.slot().
+    """
+
+    async def dependency(request: Request):
+        client = request.client.host if request.client else "unknown"
+        limiter.check_rate(client)
+        if not hold_slot:
+            yield
+            return
+        await limiter.acquire()
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    return dependency
@@ -5,6 +5,7 @@ import functools
 import logging
 import os
 from datetime import datetime
+from app.utils.shared_state import shared_counters
 
 
 # Ensure 'log' directory exists
@@ -45,6 +46,41 @@ logging.basicConfig(filename=log_filename,
                     level=logging.INFO, 
                     format="%(asctime)s - %(levelname)s - %(message)s")
 
+class PerformanceMetrics:
+    """
+        Aggregates the figures measured by log_performance per function.
+
+        The figures are kept in shared counters, so the totals cover every worker process without
+        a backend write in the request path.
+    """
+
+    FIELDS = ("calls", "total_seconds", "total_memory_mb")
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    def record(self, name, execution_time, memory_used):
+        for field, value in zip(self.FIELDS, (1, execution_time, memory_used)):
+            self.counters.add(f"metrics:{field}", name, value)
+
+    def summary(self):
+        """
+            Returns the totals of every function across all workers.
+        """
+        totals = {field: self.counters.totals(f"metrics:{field}") for field in self.FIELDS}
+        summary = {}
+        for name, calls in totals["calls"].items():
+            total_seconds = totals["total_seconds"].get(name, 0.0)
+            summary[name] = {
+                "calls": int(calls),
+                "total_seconds": total_seconds,
+                "avg_seconds": total_seconds / calls if calls else 0.0,
+                "total_memory_mb": totals["total_memory_mb"].get(name, 0.0),
+            }
+        return summary
+
+performance_metrics = PerformanceMetrics(shared_counters)
+
 def log_performance(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -67,6 +103,7 @@ def log_performance(func):
         # Log the performance
         logging.info(f"Function '{func.__name__}' executed in {execution_time:.4f} seconds")
         logging.info(f"Memory used: {memory_used:.4f} MB")
+        performance_metrics.record(func.__name__, execution_time, memory_used)
 
         return result
 
@@ -0,0 +1,373 @@
+# This file contains the shared state backends used to share caches and metrics between the uvicorn worker processes.
+#
+# Every backend exposes the same subset of the Redis commands (values are strings) so a Redis
+# server can be swapped in for the SQLite file without changing the callers :
+#     get, set(ex=), delete, incr, hincrbyfloat, hgetall, rpush, lrange, ltrim
+# and pipeline(), which queues those commands and runs them atomically on execute() like MULTI/EXEC.
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from app.utils.constants_n_credentials import SHARED_STATE_URL
+
+COMMANDS = ("get", "set", "delete", "incr", "hincrbyfloat", "hgetall", "rpush", "lrange", "ltrim")
+
+# Commands that do not write, a pipeline made only of these does not need the write lock
+READ_COMMANDS = ("get", "hgetall", "lrange")
+
+logger = logging.getLogger("project_logger")
+
+
+def _list_slice(length, start, end):
+    # Convert Redis style inclusive (possibly negative) indexes to a Python slice
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end = length + end
+    return slice(start, end + 1)
+
+
+class Pipeline:
+    """
+        Queues commands and runs them in one transaction on execute(), returning the list of their results.
+
+        Commands return the pipeline so they can be chained, as with redis-py.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._commands = []
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._commands = []
+        return False
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        return self._backend._execute(commands)
+
+
+class MemoryBackend:
+    """
+        In-process backend. Only consistent within a single worker, useful for development and tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._values = {}
+        self._expires = {}
+        self._hashes = {}
+        self._lists = {}
+
+    def pipeline(self, transaction: bool = True):
+        return Pipeline(self)
+
+    def _execute(self, commands):
+        with self._lock:
+            return [getattr(self, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+    def get(self, key):
+        with self._lock:
+            expires = self._expires.get(key)
+            if expires is not None and expires <= time.time():
+                self._values.pop(key, None)
+                self._expires.pop(key, None)
+            return self._values.get(key)
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = str(value)
+            if ex:
+                self._expires[key] = time.time() + ex
+            else:
+                self._expires.pop(key, None)
+        return True
+
+    def delete(self, *keys):
+        deleted = 0
+        with self._lock:
+            for key in keys:
+                for store in (self._values, self._hashes, self._lists):
+                    if store.pop(key, None) is not None:
+                        deleted += 1
+                self._expires.pop(key, None)
+        return deleted
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._values.get(key, 0)) + amount
+            self._values[key] = str(value)
+            return value
+
+    def hincrbyfloat(self, name, key, amount=1.0):
+        with self._lock:
+            fields = self._hashes.setdefault(name, {})
+            value = float(fields.get(key, 0)) + amount
+            fields[key] = str(value)
+            return value
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._hashes.get(name, {}))
+
+    def rpush(self, key, *values):
+        with self._lock:
+            items = self._lists.setdefault(key, [])
+            items.extend(str(value) for value in values)
+            return len(items)
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            items = self._lists.get(key, [])
+            return items[_list_slice(len(items), start, end)]
+
+    def ltrim(self, key, start, end):
+        with self._lock:
+            items = self._lists.get(key, [])
+            self._lists[key] = items[_list_slice(len(items), start, end)]
+        return True
+
+
+class SQLiteBackend:
+    """
+        Backend stored in a SQLite file, shared by every worker process on the same host.
+
+        Each thread uses its own connection. Every write, and every pipeline with a write, runs in an
+        immediate transaction, so read-modify-write commands such as incr are atomic across processes.
+        Read-only pipelines run in a deferred transaction and do not block the writers.
+    """
+
+    # Expired keys are purged once every this many set() calls
+    PURGE_EVERY = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._sets = 0
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS hashes (name TEXT, field TEXT, value TEXT, PRIMARY KEY (name, field))")
+            conn.execute("CREATE TABLE IF NOT EXISTS lists (key TEXT, seq INTEGER PRIMARY KEY AUTOINCREMENT, value TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS lists_key ON lists (key, seq)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, immediate: bool = True):
+        backend = self
+
+        class _Transaction:
+            def __enter__(self):
+                self.conn = backend._connection()
+                # A deferred transaction reads a consistent snapshot under WAL without taking the write lock
+                self.conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+                return self.conn
+
+            def __exit__(self, exc_type, exc, tb):
+                self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+                return False
+
+        return _Transaction()
+
+    def pipeline(self, transaction: bool = True):
+        return Pipeline(self)
+
+    def _execute(self, commands):
+        read_only = all(name in READ_COMMANDS for name, _, _ in commands)
+        with self._transaction(immediate=not read_only) as conn:
+            return [getattr(self, f"_{name}")(conn, *args, **kwargs) for name, args, kwargs in commands]
+
+    # Public commands : reads use the connection directly, writes run in their own transaction
+
+    def get(self, key):
+        return self._get(self._connection(), key)
+
+    def set(self, key, value, ex=None):
+        return self._execute([("set", (key, value), {"ex": ex})])[0]
+
+    def delete(self, *keys):
+        return self._execute([("delete", keys, {})])[0]
+
+    def incr(self, key, amount=1):
+        return self._execute([("incr", (key, amount), {})])[0]
+
+    def hincrbyfloat(self, name, key, amount=1.0):
+        return self._execute([("hincrbyfloat", (name, key, amount), {})])[0]
+
+    def hgetall(self, name):
+        return self._hgetall(self._connection(), name)
+
+    def rpush(self, key, *values):
+        return self._execute([("rpush", (key, *values), {})])[0]
+
+    def lrange(self, key, start, end):
+        return self._lrange(self._connection(), key, start, end)
+
+    def ltrim(self, key, start, end):
+        return self._execute([("ltrim", (key, start, end), {})])[0]
+
+    # Implementations, run on the connection of the current transaction
+
+    def _get(self, conn, key):
+        row = conn.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, conn, key, value, ex=None):
+        expires = time.time() + ex if ex else None
+        conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, str(value), expires))
+        self._sets += 1
+        if self._sets % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+        return True
+
+    def _delete(self, conn, *keys):
+        deleted = 0
+        for key in keys:
+            deleted += conn.execute("DELETE FROM kv WHERE key = ?", (key,)).rowcount > 0
+            deleted += conn.execute("DELETE FROM hashes WHERE name = ?", (key,)).rowcount > 0
+            deleted += conn.execute("DELETE FROM lists WHERE key = ?", (key,)).rowcount > 0
+        return deleted
+
+    def _incr(self, conn, key, amount=1):
+        row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        value = (int(row[0]) if row else 0) + amount
+        conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, NULL)", (key, str(value)))
+        return value
+
+    def _hincrbyfloat(self, conn, name, key, amount=1.0):
+        row = conn.execute("SELECT value FROM hashes WHERE name = ? AND field = ?", (name, key)).fetchone()
+        value = (float(row[0]) if row else 0.0) + amount
+        conn.execute("INSERT OR REPLACE INTO hashes (name, field, value) VALUES (?, ?, ?)", (name, key, str(value)))
+        return value
+
+    def _hgetall(self, conn, name):
+        return dict(conn.execute("SELECT field, value FROM hashes WHERE name = ?", (name,)).fetchall())
+
+    def _rpush(self, conn, key, *values):
+        conn.executemany("INSERT INTO lists (key, value) VALUES (?, ?)", [(key, str(value)) for value in values])
+        return conn.execute("SELECT COUNT(*) FROM lists WHERE key = ?", (key,)).fetchone()[0]
+
+    def _lrange(self, conn, key, start, end):
+        # Only fetch the requested slice, lists such as the change log hold large values
+        length = conn.execute("SELECT COUNT(*) FROM lists WHERE key = ?", (key,)).fetchone()[0]
+        window = _list_slice(length, start, end)
+        offset, stop = window.start, min(window.stop, length)
+        if stop <= offset:
+            return []
+        return [row[0] for row in conn.execute(
+            "SELECT value FROM lists WHERE key = ? ORDER BY seq LIMIT ? OFFSET ?", (key, stop - offset, offset)
+        ).fetchall()]
+
+    def _ltrim(self, conn, key, start, end):
+        seqs = [row[0] for row in conn.execute("SELECT seq FROM lists WHERE key = ? ORDER BY seq", (key,)).fetchall()]
+        kept = set(seqs[_list_slice(len(seqs), start, end)])
+        conn.executemany("DELETE FROM lists WHERE seq = ?", [(seq,) for seq in seqs if seq not in kept])
+        return True
+
+
+class SharedCounters:
+    """
+        Counters summed across all worker processes, stored as hash fields of the backend.
+
+        Increments are added up locally and a background thread flushes them every flush_interval
+        seconds in one transaction, so counting never writes to the backend in the request path.
+        Backend errors are logged and the increments kept for the next flush.
+    """
+
+    def __init__(self, backend, flush_interval: float = 1.0):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def add(self, name, field, amount=1):
+        with self._lock:
+            self._pending[(name, field)] = self._pending.get((name, field), 0) + amount
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, name="shared-counters-flusher", daemon=True)
+                self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            pipe = self.backend.pipeline()
+            for (name, field), amount in pending.items():
+                pipe.hincrbyfloat(name, field, amount)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not flush counters to the shared state: {e}")
+            # Keep the increments for the next flush, the number of counters bounds their size
+            with self._lock:
+                for counter, amount in pending.items():
+                    self._pending[counter] = self._pending.get(counter, 0) + amount
+
+    def totals(self, name):
+        """
+            Returns the fields of counter name summed across all workers, including the local increments.
+        """
+        self.flush()
+        return {field: float(value) for field, value in self.backend.hgetall(name).items()}
+
+
+def create_backend(url: str):
+    """
+        Creates the shared state backend for url.
+
+        Args :
+        url : 'memory://', 'sqlite:///<path>' or 'redis://<host>:<port>/<db>'.
+
+        Returns :
+        A backend exposing the Redis command subset listed at the top of this file.
+    """
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The 'redis' package is required for a redis:// SHARED_STATE_URL")
+        return redis.Redis.from_url(url, decode_responses=True)
+    raise ValueError(f"Unsupported shared state url: {url}")
+
+
+shared_state = create_backend(SHARED_STATE_URL)
+shared_counters = SharedCounters(shared_state)
+atexit.register(shared_counters.flush)
@@ -0,0 +1,90 @@
+# This file contains a single-flight helper used to coalesce identical concurrent calls into one execution.
+
+import asyncio
+import json
+from app.utils.shared_state import shared_counters
+
+
+class SingleFlight:
+    """
+        Coalesces concurrent calls with the same key so that only the first caller (the leader)
+        starts the coroutine while the others await the same task and reuse its result.
+
+        The coroutine runs in its own task, so a leader whose request is cancelled does not cancel
+        the call for the followers. Nothing is cached once the call finishes : the next call with
+        the same key runs again.
+    """
+
+    def __init__(self, name: str = "single_flight"):
+        self.name = name
+        self._tasks = {}
+        self.counters_name = f"single_flight:{name}"
+
+    async def do(self, key, func, *args, **kwargs):
+        """
+            Runs await func(*args, **kwargs) once for all concurrent callers sharing the same key.
+
+            Args :
+            key : Hashable key identifying identical calls.
+            func : The coroutine function to execute.
+
+            Returns :
+            The result of func. If func raises, the same exception is raised in every caller.
+        """
+
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._tasks[key] = task
+            shared_counters.add(self.counters_name, "executed")
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            shared_counters.add(self.counters_name, "coalesced")
+
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        # Remove the call so late arrivals start a fresh execution
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Mark the exception as retrieved even if every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        """
+            Returns the number of executed and coalesced calls of all workers and the calls in flight in this worker.
+        """
+        totals = shared_counters.totals(self.counters_name)
+        return {
+            "executed": int(totals.get("executed", 0)),
+            "coalesced": int(totals.get("coalesced", 0)),
+            "worker_in_flight": len(self._tasks),
+        }
+
+
+def normalise_condition(condition):
+    """
+        Builds a canonical string for a read condition so that logically identical conditions
+        (different key order or logic case) produce the same key.
+
+        Args :
+        condition : A dictionary of conditions as accepted by read_build_conditions.
+
+        Returns :
+        A canonical JSON string, or None if no condition is given.
+    """
+
+    def _normalise(node):
+        if isinstance(node, dict):
+            node = {k: _normalise(v) for k, v in node.items()}
+            if isinstance(node.get("logic"), str):
+                node["logic"] = node["logic"].lower()
+            return node
+        if isinstance(node, list):
+            return [_normalise(item) for item in node]
+        return node
+
+    if not condition:
+        return None
+    return json.dumps(_normalise(condition), sort_keys=True, separators=(",", ":"), default=str)